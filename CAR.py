@@ -3,59 +3,283 @@ import numpy as np
 from glob import glob
 import pycurl
 import argparse
-from osgeo import gdal, ogr
-import geopandas as gpd
+from osgeo import gdal, gdal_array, ogr, osr
+from pyogrio import read_dataframe
+from pyproj import Geod
 import math
+import uuid
+import json
+import time
+import queue
+import threading
+import multiprocessing
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from tqdm import tqdm
+
+# raise GDAL errors as exceptions instead of returning None
+gdal.UseExceptions()
 
 # Step 1: Read the project area shapefile
 def read_project_area(shapefile_path):
     """
     Reads the shapefile containing the project area.
     """
-    project_area = gpd.read_file(shapefile_path)
+    project_area = read_dataframe(shapefile_path)
     if project_area.crs and project_area.crs.to_epsg() != 4326:
         print("Reprojecting project area to WGS 84...")
         project_area = project_area.to_crs(epsg=4326)
     
     return project_area
 
-# Helper function to format tile name
-def format_tile_name(lat, lon):
+# Helper function to format tile names, vectorized over arrays of tile corners
+def format_tile_names(lats, lons):
     
-    lat_prefix = "N" if lat >= 0 else "S"
-    lon_prefix = "E" if lon >= 0 else "W"
+    lat_prefix = np.where(lats >= 0, "N", "S")
+    lon_prefix = np.where(lons >= 0, "E", "W")
     
-    # lat_rounded = math.floor(lat / 10) * 10
-    # lon_rounded = math.floor(lon / 10) * 10
+    # e.g. N40W100: two-digit latitude, three-digit longitude
+    lat_part = np.char.add(lat_prefix, np.char.zfill(np.abs(lats).astype('U2'), 2))
+    lon_part = np.char.add(lon_prefix, np.char.zfill(np.abs(lons).astype('U3'), 3))
     
-    return f"{lat_prefix}{abs(lat):02d}{lon_prefix}{abs(lon):03d}"
+    return np.char.add(lat_part, lon_part)
 
 def calculate_area(gdf):
-    minx, miny, maxx, maxy = gdf.total_bounds
-    central_lon = (minx + maxx) / 2
-    utm_zone = int((central_lon + 180) / 6) + 1
-    is_northern = (miny + maxy) / 2 >= 0  # Check if the data is in the northern hemisphere
-
-    # EPSG code for the UTM zone
-    epsg_code = 32600 + utm_zone if is_northern else 32700 + utm_zone
-    # Step 4: Reproject to UTM
-    gdf_utm = gdf.to_crs(epsg=epsg_code)
-    gdf_utm["area_ha"] = round(gdf_utm.geometry.area / 1e4, 2)
+    """
+    Calculates the area of the project geometries in hectares.
+    Geographic coordinates are measured on the WGS 84 ellipsoid, no reprojection is needed.
+    """
+    if gdf.crs is not None and gdf.crs.is_projected:
+        area_m2 = gdf.geometry.area.to_numpy()
+    else:
+        geod = Geod(ellps='WGS84')
+        area_m2 = np.array([abs(geod.geometry_area_perimeter(geom)[0]) for geom in gdf.geometry])
     
-    return gdf_utm[["area_ha"]].sum().item()
+    return np.round(area_m2 / 1e4, 2).sum().item()
 
 # Step 2: Find and download tiles
-def progress(download_t, downloaded, upload_t, uploaded):
-    if download_t > 0:
-        percent = downloaded / download_t * 100
-        print(f"\rDownloading: {percent:.2f}% ({downloaded}/{download_t} bytes)", end='')
+def _new_curl(share):
+    """
+    Creates an easy handle for the tile batch, sharing DNS and TLS sessions through share.
+    """
+    curl = pycurl.Curl()
+    curl.setopt(pycurl.SHARE, share)
+    curl.setopt(pycurl.FOLLOWLOCATION, True)  # Follow redirects if needed
+    curl.setopt(pycurl.CONNECTTIMEOUT, 10)    # Timeout for connection
+    curl.setopt(pycurl.TIMEOUT, 300)          # Total timeout
+    curl.setopt(pycurl.PIPEWAIT, 1)           # Prefer multiplexing over opening new connections
+    curl.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+    curl.setopt(pycurl.ACCEPT_ENCODING, "")       # Advertise every supported encoding, libcurl decodes on the fly
+    curl.setopt(pycurl.BUFFERSIZE, 256 * 1024)    # Fewer write callbacks per tile
+    return curl
 
-def find_and_download_tiles(project_area, year, output_folder):
+def _read_sidecar(output_file):
+    """
+    Reads the download record kept next to a tile, None if the tile has no record.
+    """
+    sidecar = f"{output_file}.json"
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar) as f:
+        return json.load(f)
+
+def _write_sidecar(output_file, record):
+    with open(f"{output_file}.json", 'w') as f:
+        json.dump(record, f)
+
+def tile_is_complete(output_file):
+    """
+    Checks whether a tile was fully downloaded.
+    Tiles without a download record predate the records and are trusted as they are.
+    """
+    if not os.path.exists(output_file):
+        return False
+    record = _read_sidecar(output_file)
+    return record is None or record['complete']
+
+def _start_transfer(curl, tile_url, output_file):
+    """
+    Points a reusable easy handle at one tile.
+    A partial tile is resumed with a Range request when its recorded ETag and Content-Length allow it,
+    otherwise the tile is downloaded from scratch. Only 200/206 bodies are written to disk.
+    /vsimem/ tiles are written straight into GDAL's in-memory file system and have no download record.
+    """
+    in_memory = output_file.startswith('/vsimem/')
+    record = None if in_memory else _read_sidecar(output_file)
+    resume_from = 0
+    if record is not None and record['etag'] and record['content_length'] and os.path.exists(output_file):
+        resume_from = os.path.getsize(output_file)
+        if resume_from >= record['content_length']:
+            resume_from = 0
+    
+    curl.output_file = output_file
+    curl.status = None
+    curl.headers = {}
+    if in_memory:
+        curl.fp = gdal.VSIFOpenL(output_file, 'wb')
+        write_chunk = lambda data: gdal.VSIFWriteL(data, 1, len(data), curl.fp)
+    else:
+        if not resume_from:
+            # record the tile as incomplete before the file exists, so an interrupted run never leaves
+            # a file without a record, which tile_is_complete would trust as a finished tile
+            _write_sidecar(output_file, {'etag': None, 'content_length': None, 'complete': False})
+        curl.fp = open(output_file, 'ab' if resume_from else 'wb')
+        write_chunk = curl.fp.write
+    
+    def header_line(line):
+        line = line.decode('iso-8859-1').strip()
+        if line.startswith('HTTP/'):
+            curl.status = int(line.split()[1])
+            curl.headers = {}
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            curl.headers[name.strip().lower()] = value.strip()
+        elif not line and curl.status in (200, 206) and not in_memory:
+            # end of the final response headers
+            if curl.status == 200 and resume_from:
+                # the tile changed on the server (If-Range failed), start over
+                curl.fp.seek(0)
+                curl.fp.truncate()
+            content_length = None
+            if curl.headers.get('content-encoding', 'identity') == 'identity':
+                if curl.status == 206 and '/' in curl.headers.get('content-range', ''):
+                    content_length = int(curl.headers['content-range'].split('/')[-1])
+                elif 'content-length' in curl.headers:
+                    content_length = int(curl.headers['content-length'])
+            _write_sidecar(output_file, {'etag': curl.headers.get('etag'),
+                                         'content_length': content_length,
+                                         'complete': False})
+    
+    def write(data):
+        if curl.status in (200, 206):
+            write_chunk(data)
+    
+    curl.setopt(pycurl.URL, tile_url)
+    curl.setopt(pycurl.HEADERFUNCTION, header_line)
+    curl.setopt(pycurl.WRITEFUNCTION, write)
+    curl.setopt(pycurl.RESUME_FROM_LARGE, resume_from)
+    curl.setopt(pycurl.HTTPHEADER, [f"If-Range: {record['etag']}"] if resume_from else [])
+
+def _finish_transfer(curl, success):
+    """
+    Closes the tile file of a finished handle and returns the HTTP status code.
+    A /vsimem/ tile that did not download is removed, it cannot be resumed.
+    """
+    status = curl.getinfo(pycurl.RESPONSE_CODE)
+    if curl.output_file.startswith('/vsimem/'):
+        gdal.VSIFCloseL(curl.fp)
+        if not (success and status in (200, 206)):
+            gdal.Unlink(curl.output_file)
+    else:
+        curl.fp.close()
+    return status
+
+def _discard_tile(output_file):
+    for path in (output_file, f"{output_file}.json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+def download_tiles(jobs, max_connections=8, desc='Downloading tiles', max_attempts=4):
+    """
+    Downloads a list of (tile_url, output_file) jobs as a single libcurl multi batch.
+    At most max_connections transfers run at once; easy handles are reused between tiles.
+    Connection errors, HTTP 429 and 5xx are retried up to max_attempts times with 1, 2, 4, 8 s backoff,
+    resuming from the bytes already on disk.
+    Returns the list of downloaded files, failed tiles are reported and skipped.
+    """
+    downloaded_files = []
+    if not jobs:
+        return downloaded_files
+    
+    share = pycurl.CurlShare()
+    share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+    share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+    
+    multi = pycurl.CurlMulti()
+    multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+    multi.setopt(pycurl.M_MAXCONNECTS, max_connections)
+    free_handles = [_new_curl(share) for _ in range(min(max_connections, len(jobs)))]
+    all_handles = list(free_handles)
+    
+    # (not before, attempt, tile_url, output_file)
+    pending = [(0.0, 1, tile_url, output_file) for tile_url, output_file in jobs]
+    num_processed = 0
+    num_handles = 0
+    with tqdm(total=len(jobs), desc=desc) as progress_bar:
+        while num_processed < len(jobs):
+            # Hand the tiles that are due to the free handles
+            now = time.monotonic()
+            for job in [job for job in pending if job[0] <= now]:
+                if not free_handles:
+                    break
+                pending.remove(job)
+                _, attempt, tile_url, output_file = job
+                curl = free_handles.pop()
+                curl.attempt = attempt
+                curl.tile_url = tile_url
+                _start_transfer(curl, tile_url, output_file)
+                multi.add_handle(curl)
+            
+            # Drive all running transfers
+            while True:
+                ret, num_handles = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            
+            # Harvest finished transfers
+            while True:
+                num_queued, ok_list, err_list = multi.info_read()
+                finished = [(curl, None) for curl in ok_list] + [(curl, errmsg) for curl, errno, errmsg in err_list]
+                for curl, errmsg in finished:
+                    status = _finish_transfer(curl, success=errmsg is None)
+                    multi.remove_handle(curl)
+                    free_handles.append(curl)
+                    tile_filename = os.path.basename(curl.output_file)
+                    if errmsg is None and status in (200, 206):
+                        if not curl.output_file.startswith('/vsimem/'):
+                            record = _read_sidecar(curl.output_file) or {'etag': None, 'content_length': None}
+                            record['complete'] = True
+                            _write_sidecar(curl.output_file, record)
+                        downloaded_files.append(curl.output_file)
+                    elif (errmsg is not None or status == 429 or status >= 500) and curl.attempt < max_attempts:
+                        # transient failure, retry later and resume from what is on disk
+                        pending.append((time.monotonic() + 2 ** (curl.attempt - 1), curl.attempt + 1, curl.tile_url, curl.output_file))
+                        continue
+                    else:
+                        if errmsg is None:
+                            # the server refused the tile (e.g. 404 for tiles without land), nothing worth keeping
+                            _discard_tile(curl.output_file)
+                            errmsg = f"HTTP {status}"
+                        elif _read_sidecar(curl.output_file) is None:
+                            # a partial file without a record would pass for a finished tile on the next run
+                            _discard_tile(curl.output_file)
+                        print(f"Failed to download {tile_filename}: {errmsg}")
+                    num_processed += 1
+                    progress_bar.update(1)
+                if num_queued == 0:
+                    break
+            
+            if num_handles:
+                multi.select(1.0)
+            elif pending:
+                # only retries are left, wait for the earliest one
+                time.sleep(max(min(job[0] for job in pending) - time.monotonic(), 0))
+    
+    for curl in all_handles:
+        curl.close()
+    multi.close()
+    share.close()
+    return downloaded_files
+
+def find_and_download_tiles(project_area, year, output_folder=None, max_workers=8):
     """
     Finds and downloads tiles that cover the project area.
+    Missing tiles are downloaded as one parallel batch of at most max_workers transfers.
+    Tiles are cached in output_folder; without it they are kept in memory under /vsimem/ and never touch the disk.
     """
-    if not os.path.exists(output_folder):
+    if output_folder is None:
+        output_folder = '/vsimem/'
+    elif not os.path.exists(output_folder):
         os.makedirs(output_folder)
     
     # Calculate the bounding box of the project area
@@ -63,92 +287,252 @@ def find_and_download_tiles(project_area, year, output_folder):
     minx, miny, maxx, maxy = bounds
     
     # Determine the tile coordinates covering the bounding box
+    # tiles are named after their upper-left corner, hence floor for lon and ceil for lat
     min_tile_x = math.floor(minx / 10) * 10
     max_tile_x = math.floor(maxx / 10) * 10
     min_tile_y = math.ceil(miny / 10) * 10
     max_tile_y = math.ceil(maxy / 10) * 10
     
-    # Generate a list of tiles based on the tile naming convention
+    # Grid of tile corners as two flat arrays
+    tile_lats, tile_lons = np.meshgrid(np.arange(min_tile_y, max_tile_y + 10, 10),
+                                       np.arange(min_tile_x, max_tile_x + 10, 10),
+                                       indexing='ij')
+    
+    # Generate the tile file names and URLs based on the tile naming convention
+    tile_names = format_tile_names(tile_lats.ravel(), tile_lons.ravel())
+    tile_filenames = np.char.add(tile_names, f"_ESACCI-BIOMASS-L4-AGB-MERGED-100m-{year}-fv5.0.tif")
+    tile_urls = np.char.add(f"https://dap.ceda.ac.uk/neodc/esacci/biomass/data/agb/maps/v5.01/geotiff/{year}/", tile_filenames)
+    
     downloaded_files = []
-    for lat in range(min_tile_y, max_tile_y + 10, 10):
-        for lon in range(min_tile_x, max_tile_x + 10, 10):
-            tile_name = format_tile_name(lat, lon)
-            tile_filename = f"{tile_name}_ESACCI-BIOMASS-L4-AGB-MERGED-100m-{year}-fv5.0.tif"
-            output_file = os.path.join(output_folder, tile_filename)
-            
-            if os.path.exists(output_file):
-                print(f'Image tile downloaded already, check {output_file}')
+    jobs = []
+    for tile_filename, tile_url in zip(tile_filenames.tolist(), tile_urls.tolist()):
+        output_file = os.path.join(output_folder, tile_filename)
+        
+        if output_file.startswith('/vsimem/'):
+            if gdal.VSIStatL(output_file) is not None:
                 downloaded_files.append(output_file)
                 continue
-            
-            tile_url = f"https://dap.ceda.ac.uk/neodc/esacci/biomass/data/agb/maps/v5.01/geotiff/{year}/{tile_filename}"
-            print(f"Downloading {tile_filename} from {tile_url}...")
-            
-            # Download using pycurl
-            try:
-                with open(output_file, 'wb') as f:
-                    curl = pycurl.Curl()
-                    curl.setopt(curl.URL, tile_url)
-                    curl.setopt(curl.WRITEDATA, f)
-                    curl.setopt(curl.FOLLOWLOCATION, True)  # Follow redirects if needed
-                    curl.setopt(curl.CONNECTTIMEOUT, 10)    # Timeout for connection
-                    curl.setopt(curl.TIMEOUT, 300)         # Total timeout
-                    curl.setopt(curl.NOPROGRESS, False)    # Enable progress function
-                    curl.setopt(curl.XFERINFOFUNCTION, progress)  # Set progress function
-                    curl.perform()
-                    curl.close()
-                downloaded_files.append(output_file)
-                print(f"Downloaded {output_file}")
-            except pycurl.error as e:
-                print(f"Failed to download {tile_filename}: {e}")
+        elif tile_is_complete(output_file):
+            print(f'Image tile downloaded already, check {output_file}')
+            downloaded_files.append(output_file)
+            continue
+        
+        jobs.append((tile_url, output_file))
+    
+    # Download the missing tiles using pycurl, all in one multi batch
+    downloaded_files += download_tiles(jobs, max_connections=max_workers, desc=f'Downloading {year} tiles')
     
     return downloaded_files
 
-def mask_and_calculate_gdal(raster_tiles_list, shapefile_path, nodata=65535):
+def _valid_pixels(block, nodata, mask, out):
+    valid = np.not_equal(block, nodata, out=out)
+    if mask is not None:
+        np.logical_and(valid, mask, out=valid)
+    return valid
+
+def _reduce_integer(block, nodata, mask=None, out=None):
     """
-    Masks a raster using a shapefile and calculates the sum and mean of pixel values.
-    No intermediate files are created.
+    Kernel for integer rasters (ESA AGB, uint16 with nodata 65535): summed exactly in 64-bit integers, no float upcast.
     """
-    # Perform masking using GDAL Warp (in-memory)
-    # print("Masking raster in-memory with GDAL...")
-    mem_raster = gdal.Warp(destNameOrDestDS="", 
-                           srcDSOrSrcDSTab=raster_tiles_list, 
-                           cutlineDSName=shapefile_path,
-                           cropToCutline=True,
-                           dstNodata=nodata,
-                           format="MEM")
+    valid = _valid_pixels(block, nodata, mask, out)
+    accumulator = np.uint64 if block.dtype.kind == 'u' else np.int64
+    return int(np.count_nonzero(valid)), int(np.add.reduce(block, axis=None, where=valid, dtype=accumulator))
 
-    if mem_raster is None:
-        raise RuntimeError("Raster masking failed.")
+def _reduce_float(block, nodata, mask=None, out=None):
+    """
+    Kernel for float rasters (GEDI and CONAFOR, float32 with nodata -9999): NaN pixels are not valid either.
+    """
+    valid = _valid_pixels(block, nodata, mask, out)
+    # NaN != NaN, evaluated only where still valid
+    np.equal(block, block, out=valid, where=valid)
+    return int(np.count_nonzero(valid)), float(np.add.reduce(block, axis=None, where=valid, dtype=np.float64))
+
+def _specialize(dtype, nodata):
+    """
+    Picks the reduction kernel for a raster data type once, and casts nodata to that type when it fits,
+    so the per-block comparison runs on the raster's own dtype.
+    """
+    kernel = _reduce_float if dtype.kind == 'f' else _reduce_integer
+    if np.can_cast(np.min_scalar_type(nodata), dtype):
+        nodata = dtype.type(nodata)
+    return kernel, nodata
+
+def _reduce_window(band, xoff, yoff, xsize, ysize, nodata, masks):
+    """
+    Counts and sums the valid pixels of a band window under each of the boolean masks,
+    a (n, ysize, xsize) array. The window is streamed block by block into buffers allocated once,
+    and every block is read a single time whatever the number of masks.
+    """
+    block_x, block_y = band.GetBlockSize()
+    # MEM rasters report one scanline per block, group rows into windows of about 1M pixels
+    block_y = max(block_y, (1 << 20) // max(xsize, 1))
+    block_x, block_y = min(block_x, xsize), min(block_y, ysize)
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    kernel, nodata = _specialize(dtype, nodata)
+    data_buffer = np.empty((block_y, block_x), dtype=dtype)
+    valid_buffer = np.empty((block_y, block_x), dtype=bool)
 
-    # Read data from the in-memory raster
-    band = mem_raster.GetRasterBand(1)
-    data = band.ReadAsArray()
+    counts, total_sums = [0] * len(masks), [0] * len(masks)
+    for row in range(0, ysize, block_y):
+        rows = min(block_y, ysize - row)
+        for col in range(0, xsize, block_x):
+            cols = min(block_x, xsize - col)
+            block = data_buffer if (rows, cols) == data_buffer.shape else np.empty((rows, cols), dtype=data_buffer.dtype)
+            band.ReadAsArray(xoff + col, yoff + row, cols, rows, buf_obj=block)
+            for i, mask in enumerate(masks):
+                block_count, block_sum = kernel(block, nodata, mask=mask[row:row + rows, col:col + cols],
+                                                out=valid_buffer[:rows, :cols])
+                counts[i] += block_count
+                total_sums[i] += block_sum
+    return list(zip(counts, total_sums))
 
-    # print("Calculating statistics...")
-    data = data[data != nodata]
+def _layer_extent(layer, raster_wkt):
+    """
+    Returns the (minx, miny, maxx, maxy) extent of an OGR layer in the raster's coordinate system.
+    """
+    minx, maxx, miny, maxy = layer.GetExtent()
+    raster_srs = osr.SpatialReference(wkt=raster_wkt)
+    layer_srs = layer.GetSpatialRef()
+    if layer_srs is not None and not layer_srs.IsSame(raster_srs):
+        raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        layer_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(layer_srs, raster_srs)
+        minx, miny, maxx, maxy = transform.TransformBounds(minx, miny, maxx, maxy, 21)
+    return minx, miny, maxx, maxy
 
-    if data.size == 0:
-        print("No valid pixels found in the masked raster.")
-        total_sum = 0
-        mean_value = 0
-    else:
-        count = len(data)
-        total_sum = np.sum(data)
-        mean_value = np.nanmean(data)
+def build_cutline_masks(shapefile_paths, raster_path):
+    """
+    Rasterizes each shapefile onto the pixel grid of the raster, over the shapefiles' common extent only.
+    Returns the boolean masks as one (n, rows, cols) array and their shared geotransform,
+    so they can be reused for every raster on the same grid and reduced from a single read.
+    """
+    template = gdal.Open(raster_path)
+    gt = template.GetGeoTransform()
+
+    shapefiles = [ogr.Open(shapefile_path) for shapefile_path in shapefile_paths]
+    layers = [shapefile.GetLayer() for shapefile in shapefiles]
+    extents = np.array([_layer_extent(layer, template.GetProjection()) for layer in layers])
+    minx, miny = extents[:, :2].min(axis=0)
+    maxx, maxy = extents[:, 2:].max(axis=0)
+
+    # snap the extent outwards to the raster grid
+    col_min = math.floor((minx - gt[0]) / gt[1])
+    col_max = math.ceil((maxx - gt[0]) / gt[1])
+    row_min = math.floor((maxy - gt[3]) / gt[5])
+    row_max = math.ceil((miny - gt[3]) / gt[5])
+    mask_gt = (gt[0] + col_min * gt[1], gt[1], 0, gt[3] + row_min * gt[5], 0, gt[5])
+
+    mask_raster = gdal.GetDriverByName("MEM").Create("", max(col_max - col_min, 1), max(row_max - row_min, 1), len(layers), gdal.GDT_Byte)
+    mask_raster.SetGeoTransform(mask_gt)
+    mask_raster.SetProjection(template.GetProjection())
+    for i, layer in enumerate(layers):
+        gdal.RasterizeLayer(mask_raster, [i + 1], layer, burn_values=[1])
+    masks = mask_raster.ReadAsArray().reshape(len(layers), mask_raster.RasterYSize, mask_raster.RasterXSize).astype(bool)
+
+    # trim the masks to the bounding box of their nonzero pixels, so reads skip the empty margins
+    footprint = masks.any(axis=0)
+    rows = np.flatnonzero(footprint.any(axis=1))
+    cols = np.flatnonzero(footprint.any(axis=0))
+    if rows.size:
+        masks = masks[:, rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        mask_gt = (mask_gt[0] + cols[0] * gt[1], gt[1], 0, mask_gt[3] + rows[0] * gt[5], 0, gt[5])
+
+    # Clean up memory
+    mask_raster = None
+    template = None
+    layers = shapefiles = None
+    return masks, mask_gt
+
+def apply_masks_and_reduce(raster_path, masks, mask_gt, nodata=65535):
+    """
+    Calculates the count, sum and mean of pixel values under each mask from build_cutline_masks.
+    Only the masks' window of the raster (usually a VRT mosaic of the tiles) is read, and only once.
+    """
+    mosaic = gdal.Open(raster_path)
+    gt = mosaic.GetGeoTransform()
+    band = mosaic.GetRasterBand(1)
+
+    # position of the masks in the mosaic, clipped to the mosaic extent
+    col = int(round((mask_gt[0] - gt[0]) / gt[1]))
+    row = int(round((mask_gt[3] - gt[3]) / gt[5]))
+    x0, y0 = max(col, 0), max(row, 0)
+    x1, y1 = min(col + masks.shape[2], band.XSize), min(row + masks.shape[1], band.YSize)
+
+    sums = [(0, 0)] * len(masks)
+    if x1 > x0 and y1 > y0:
+        window_masks = masks[:, y0 - row:y1 - row, x0 - col:x1 - col]
+        sums = _reduce_window(band, x0, y0, x1 - x0, y1 - y0, nodata, window_masks)
+
+    results = []
+    for count, total_sum in sums:
+        if count == 0:
+            print("No valid pixels found under the mask.")
+        mean_value = total_sum / count if count else 0.0
+        results.append((count, total_sum, mean_value))
 
     # Clean up memory
-    mem_raster = None
-    raster = None
-    shapefile = None
+    mosaic = None
+    return results
+
+def download_years(project_area, years, output_folder, max_workers, tile_queue):
+    """
+    Producer of the download/extraction pipeline: downloads the tiles year by year and
+    puts (year, tile_files) on tile_queue as soon as a year is complete, then None.
+    If a download raises, the exception is put on tile_queue instead, for next_tile_batch to re-raise.
+    """
+    try:
+        for year in years:
+            tile_queue.put((year, find_and_download_tiles(project_area, year, output_folder, max_workers=max_workers)))
+        tile_queue.put(None)
+    except BaseException as error:
+        # always release the consumer, with the error so it is not lost in this thread
+        tile_queue.put(error)
+
+def next_tile_batch(tile_queue):
+    """
+    Consumer side of download_years: the next (year, tile_files), None at the end,
+    or the downloader's exception raised in the calling thread.
+    """
+    item = tile_queue.get()
+    if isinstance(item, BaseException):
+        raise item
+    return item
+
+# cutline masks of the current worker, set once per worker by _init_reduce_worker
+_worker_masks = None
+
+def _init_reduce_worker(masks, mask_gt):
+    """
+    Pool initializer: receives the cutline masks once per worker instead of once per job.
+    """
+    global _worker_masks
+    _worker_masks = (masks, mask_gt)
+
+def _reduce_job(job):
+    """
+    Worker for the per-year extraction: mosaics one year's tiles and reduces them under the worker's masks.
+    Usually runs in a separate process, so the mosaic is built there rather than shared through /vsimem.
+    """
+    year, tile_files, nodata = job
+    masks, mask_gt = _worker_masks
+    mosaic_path = f'/vsimem/{year}_{uuid.uuid4().hex}.vrt'
+    mosaic = gdal.BuildVRT(mosaic_path, tile_files, VRTNodata=nodata)
+    mosaic = None
+    results = apply_masks_and_reduce(mosaic_path, masks, mask_gt, nodata)
+    gdal.Unlink(mosaic_path)
+    return results
 
-    # print(f"Total Sum: {total_sum}, Mean Value: {mean_value}")
-    return count, total_sum, mean_value
+def release_memory_tiles(tile_files):
+    for tile_file in tile_files:
+        if tile_file.startswith('/vsimem/'):
+            gdal.Unlink(tile_file)
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('-pid', '--pid', type=str, help='project ID', required=True)
     # parser.add_argument('-year', '--year', type=int, help='project start year', required=True)
+    parser.add_argument('-workers', '--workers', type=int, default=8, help='number of parallel tile downloads')
+    parser.add_argument('--in-memory', action='store_true', help='keep downloaded tiles in memory instead of caching them in Projects/ESA/')
     args = parser.parse_args()
     return args
 
@@ -158,7 +542,8 @@ if __name__ == "__main__":
     # Input parameters
     args = parse_arguments()
     pid = args.pid
-    output_folder=r'Projects/ESA/'
+    # tiles are cached on disk unless asked to stay in memory
+    output_folder = None if args.in_memory else r'Projects/ESA/'
     
     # change the project folder when necessary
     aa_path = glob(f'Projects/CAR-Mexico/{pid}/*.shp')[0]
@@ -175,32 +560,60 @@ if __name__ == "__main__":
     print(f'Project area size: {calculate_area(pa)} ha')
     
     
-    aa_agb, aa_mean_agb, pa_agb, pa_mean_agb = [], [], [], []
+    years = [2010, 2015, 2016, 2017, 2018, 2019, 2020, 2021]
+    # Step 2: Find and download tiles covering the project area, in the background,
+    # so a year is extracted while the following years are still downloading
+    print("Finding and downloading tiles...")
+    tile_queue = queue.Queue()
+    downloader = threading.Thread(target=download_years, args=(pa, years, output_folder, args.workers, tile_queue), daemon=True)
+    downloader.start()
     
-    for year in [2010, 2015, 2016, 2017, 2018, 2019, 2020, 2021]:
-        print(f'Year: {year}')
-    # Step 2: Find and download tiles covering the project area
-        print("Finding and downloading tiles...")
-        tile_files = find_and_download_tiles(pa, year, output_folder)
-        # Step 3: Perform statistics
-        print("Extracting AGB values from images")
-        
-        _, total_sum, mean_value = mask_and_calculate_gdal(raster_tiles_list=tile_files, shapefile_path=aa_path)
-        print(f'Year: {year}, total AGB in AA: {total_sum}, mean value: {mean_value}')
-        aa_agb.append(total_sum)
-        aa_mean_agb.append(mean_value)
-        
-        _, total_sum, mean_value = mask_and_calculate_gdal(raster_tiles_list=tile_files, shapefile_path=pa_path)
-        print(f'Year: {year}, total AGB in PA: {total_sum}, mean value: {mean_value}')
-        pa_agb.append(total_sum)
-        pa_mean_agb.append(mean_value)
-        print(' ')
+    # Step 3: Perform statistics, every year is independent, one process each;
+    # in-memory tiles live in this process's /vsimem, so they are reduced by threads instead
+    # the tile grid is the same every year, so the cutlines are rasterized only once, on the first year's tiles,
+    # AA and PA on a shared window so each year's tiles are read once for both
+    item = next_tile_batch(tile_queue)
+    mosaic_path = '/vsimem/template.vrt'
+    mosaic = gdal.BuildVRT(mosaic_path, item[1], VRTNodata=65535)
+    mosaic = None
+    masks = build_cutline_masks([aa_path, pa_path], mosaic_path)
+    gdal.Unlink(mosaic_path)
+    
+    futures = {}
+    # the masks are handed to each worker once by the initializer, jobs only carry the year's tiles;
+    # worker processes are spawned rather than forked, the downloader thread is running while they start
+    if args.in_memory:
+        executor = ThreadPoolExecutor(max_workers=os.cpu_count(), initializer=_init_reduce_worker, initargs=masks)
+    else:
+        executor = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_reduce_worker, initargs=masks)
+    with executor:
+        while item is not None:
+            year, tile_files = item
+            print(f"Year: {year}, extracting AGB values from images")
+            futures[year] = executor.submit(_reduce_job, (year, tile_files, 65535))
+            # in-memory tiles are only needed for this year's reduction, free them as soon as it is done
+            futures[year].add_done_callback(lambda future, tile_files=tile_files: release_memory_tiles(tile_files))
+            item = next_tile_batch(tile_queue)
+        results = [futures[year].result() for year in years]
+    downloader.join()
+    print(' ')
+    
+    aa_agb, aa_mean_agb, pa_agb, pa_mean_agb = [], [], [], []
+    for year, ((_, aa_sum, aa_mean), (_, pa_sum, pa_mean)) in zip(years, results):
+        print(f'Year: {year}, total AGB in AA: {aa_sum}, mean value: {aa_mean}')
+        print(f'Year: {year}, total AGB in PA: {pa_sum}, mean value: {pa_mean}')
+        aa_agb.append(aa_sum)
+        aa_mean_agb.append(aa_mean)
+        pa_agb.append(pa_sum)
+        pa_mean_agb.append(pa_mean)
+    print(' ')
     
     dataframe = pd.DataFrame({'AA_AGB_SUM': aa_agb,
                               'AA_AGB_MEAN': aa_mean_agb,
                               'PA_AGB_SUM':pa_agb,
                               'PA_AGB_MEAN':pa_mean_agb}, 
-                             index=[2010, 2015, 2016, 2017, 2018, 2019, 2020, 2021])
+                             index=years)
     
     print(dataframe)
     if os.path.exists(f'Projects/CAR-Mexico/{pid}_out.csv'):
@@ -210,24 +623,21 @@ if __name__ == "__main__":
         print(f'Export results to csv, please find it: Projects/CAR-Mexico/{pid}_out.csv')
     
     print('Using GEDI image for biomass mapping')
-    GEDI_files = ['Projects/ESA/GEDI04_B_MW019MW223_02_002_02_R01000M_MU.tif']
-    _, _, mean_value = mask_and_calculate_gdal(raster_tiles_list=GEDI_files, shapefile_path=aa_path, nodata=-9999)
-    print(f'mean AGBD value in AA: {mean_value}')
+    GEDI_MU = 'Projects/ESA/GEDI04_B_MW019MW223_02_002_02_R01000M_MU.tif'
+    GEDI_SE = 'Projects/ESA/GEDI04_B_MW019MW223_02_002_02_R01000M_SE.tif'
+    # the mean and standard error products share one grid, rasterize the cutlines once for both
+    gedi_masks = build_cutline_masks([aa_path, pa_path], GEDI_MU)
+    (_, _, aa_mean), (_, _, pa_mean) = apply_masks_and_reduce(GEDI_MU, *gedi_masks, nodata=-9999)
+    print(f'mean AGBD value in AA: {aa_mean}')
+    print(f'mean AGBD value in PA: {pa_mean}')
     
-    _, _, mean_value = mask_and_calculate_gdal(raster_tiles_list=GEDI_files, shapefile_path=pa_path, nodata=-9999)
-    print(f'mean AGBD value in PA: {mean_value}')
-    
-    GEDI_files = ['Projects/ESA/GEDI04_B_MW019MW223_02_002_02_R01000M_SE.tif']
-    _, _, mean_value = mask_and_calculate_gdal(raster_tiles_list=GEDI_files, shapefile_path=aa_path, nodata=-9999)
-    print(f'mean SE value in AA: {mean_value}')
-    
-    _, _, mean_value = mask_and_calculate_gdal(raster_tiles_list=GEDI_files, shapefile_path=pa_path, nodata=-9999)
-    print(f'mean SE value in PA: {mean_value}')
+    (_, _, aa_mean), (_, _, pa_mean) = apply_masks_and_reduce(GEDI_SE, *gedi_masks, nodata=-9999)
+    print(f'mean SE value in AA: {aa_mean}')
+    print(f'mean SE value in PA: {pa_mean}')
     
     print('Using CONAFOR for biomass mapping')
-    CONAFOR_files = ['Projects/ESA/CONAFOR.tif']
-    count, _, mean_value = mask_and_calculate_gdal(raster_tiles_list=CONAFOR_files, shapefile_path=aa_path, nodata=-9999)
-    print(f'{count} pixels used and mean AGBD value in AA: {mean_value}')
-    
-    count, _, mean_value = mask_and_calculate_gdal(raster_tiles_list=CONAFOR_files, shapefile_path=pa_path, nodata=-9999)
-    print(f'{count} pixels used and mean AGBD value in PA: {mean_value}')
\ No newline at end of file
+    CONAFOR_file = 'Projects/ESA/CONAFOR.tif'
+    conafor_masks = build_cutline_masks([aa_path, pa_path], CONAFOR_file)
+    (aa_count, _, aa_mean), (pa_count, _, pa_mean) = apply_masks_and_reduce(CONAFOR_file, *conafor_masks, nodata=-9999)
+    print(f'{aa_count} pixels used and mean AGBD value in AA: {aa_mean}')
+    print(f'{pa_count} pixels used and mean AGBD value in PA: {pa_mean}')
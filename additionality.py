@@ -1,6 +1,9 @@
  # load geemap and other packages
 import argparse
 import os
+import time
+import json
+import hashlib
 import ee
 import geemap
 from glob import glob
@@ -10,25 +13,45 @@ import geopandas as gpd
 
 # crs conversion
 def crs_conversion(project_area_path):
-    project_df = gpd.read_file(project_area_path)
+    project_df = gpd.read_file(project_area_path, engine='pyogrio')
     # print(f'original crs:{project_df.crs}')
     
     project_df_wgs84 = project_df.to_crs(epsg=4326)
     # print(f'new crs: {project_df_wgs84.crs}')
     
-    centroid = project_df_wgs84.unary_union.centroid
-    lon = centroid.x
+    # the bounding box midpoint is enough to pick the UTM zone, no need to union the polygons
+    minx, miny, maxx, maxy = project_df_wgs84.total_bounds
+    lon = (minx + maxx) / 2
     utm_zone = int((lon + 180) // 6) + 1
     epsg_number = 32600+utm_zone
     # print(f'new project crs: EPSG:326{utm_zone}')
     project_df_wgs84_p = project_df_wgs84.to_crs(epsg=epsg_number)
     # remove small polygons less than 1 ha
-    project_df_wgs84_p['area'] = project_df_wgs84_p.area
-    project_df_filter = project_df_wgs84_p[project_df_wgs84_p['area'] > 10000]
+    areas = project_df_wgs84_p.geometry.area.values
+    project_df_filter = project_df_wgs84_p.iloc[areas > 10000]
     
     return epsg_number, project_df_filter
 
+# on-disk cache of getInfo() results, so re-runs for the same project skip finished reductions
+CACHE_DIR = '.ee_cache'
+CACHE_TTL = 30 * 24 * 3600  # 30 days
+
+def cached_getinfo(op_name, params, fn):
+    # key on the operation and its parameters; fn is only called on a miss
+    key = hashlib.md5((op_name + json.dumps(params, sort_keys=True)).encode()).hexdigest()
+    cache_file = os.path.join(CACHE_DIR, f'{key}.json')
+    if os.path.exists(cache_file) and time.time() - os.path.getmtime(cache_file) < CACHE_TTL:
+        with open(cache_file) as f:
+            return json.load(f)
+    value = fn()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(f'{cache_file}.tmp', 'w') as f:
+        json.dump(value, f)
+    os.replace(f'{cache_file}.tmp', cache_file)
+    return value
+
 # some functions used later
+# they build the reductions server-side only, the results are fetched later with getInfo()
 def get_annual_loss(loss_image, loss_year, region, crs):
     loss_area = loss_image.multiply(ee.Image.pixelArea())
     loss_area_year = loss_area.addBands(loss_year).reduceRegion(
@@ -36,30 +59,82 @@ def get_annual_loss(loss_image, loss_year, region, crs):
            'geometry': region,
            'scale': 30,
            'crs':f'EPSG:{crs}',
-           'bestEffort': True,
-           'maxPixels': 1e9})
-    loss_area_year = loss_area_year.getInfo()['groups']
-    years, annual_deforestation = [], []
-    for g in loss_area_year:
-        years.append(g['group'])
-        annual_deforestation.append(g['sum']/10000)    
-    return years, annual_deforestation
+           'maxPixels': 1e13,
+           'tileScale': 4})
+    return loss_area_year.get('groups')
+
+def parse_annual_loss(loss_area_year):
+    # one structured array instead of two growing lists, areas converted from m2 to ha
+    groups = np.fromiter(((g['group'], g['sum']) for g in loss_area_year),
+                         dtype=np.dtype([('year', 'i4'), ('sum', 'f8')]), count=len(loss_area_year))
+    return groups['year'], groups['sum'] / 10000
+
+def region_reduce(image, reducer, region, scale, crs):
+    return image.reduceRegion(reducer=reducer, geometry=region, scale=scale, crs=f'EPSG:{crs}', maxPixels=1e9)
+
+def region_histogram(image, reducer, band, region, scale, crs):
+    return region_reduce(image, reducer, region, scale, crs).get(band)
+
+def combined_10m_histograms(slope, landcover, canopy_height, region, crs):
+    # slope, land cover and canopy height share the 10m grid, so one reduceRegion reads them together;
+    # each band goes to its own reducer (sharedInputs=False), outputs are named slope, lc and ch.
+    # a multi-input reducer only sees pixels unmasked in every band, so each band is unmasked to a value
+    # its own histogram drops: -1 is outside both fixed ranges, land cover 0 is removed in merge_tile_histograms
+    image = slope.unmask(-1).rename('slope') \
+        .addBands(landcover.unmask(0).rename('lc')) \
+        .addBands(canopy_height.unmask(-1).rename('ch'))
+    reducer = ee.Reducer.fixedHistogram(0, 90, 18).setOutputs(['slope']) \
+        .combine(ee.Reducer.frequencyHistogram().setOutputs(['lc']), sharedInputs=False) \
+        .combine(ee.Reducer.fixedHistogram(0, 50, 10).setOutputs(['ch']), sharedInputs=False)
+    # split large project areas into 10 km tiles so each reduction stays bounded and runs in parallel,
+    # the per-tile histograms are summed client-side with merge_tile_histograms
+    grid = region.coveringGrid(f'EPSG:{crs}', 10000)
+    tiles = grid.map(lambda tile: tile.set(
+        'hist', region_reduce(image, reducer, tile.geometry().intersection(region, ee.ErrorMargin(1)), 10, crs)))
+    return tiles.aggregate_array('hist')
 
-def water_buffer(water_bodies, forest, dis, crs):
-    distance_to_water = water_bodies.Not().cumulativeCost(source=water_bodies, maxDistance=30)
-    buffered_water = distance_to_water.lte(dis)
-    # Intersect the forest raster with the buffered water mask
-    forest_near_water = forest.updateMask(buffered_water)
-    # Calculate the total forest coverage within 30 meters of water bodies
-    forest_area = forest_near_water.multiply(ee.Image.pixelArea()).reduceRegion(
-        reducer=ee.Reducer.sum(),
-        geometry=pa,  # Use the extent of the forest image
-        scale=10,
-        crs=f'EPSG:{epsg_number}',# Match the dataset resolution
-        maxPixels=1e9
-    )
-    total_forest_area = forest_area.get('Map').getInfo()
-    print(f"Total forest area within {dis} meters buffer of water: {total_forest_area / 1e4:.2f} hectares, {100 * total_forest_area / 1e4 / pa_area:.4f}%")
+def merge_tile_histograms(tile_histograms):
+    # fixed histograms share their bins across tiles, so the counts add up row by row;
+    # frequency histograms are dicts keyed by class and are summed key by key
+    merged = {}
+    for band in ['slope', 'ch']:
+        hists = np.array([h[band] for h in tile_histograms if h.get(band)], dtype=float)
+        if len(hists) == 0:
+            # no tile had data for this band, e.g. outside 3DEP coverage
+            merged[band] = np.empty((0, 2))
+            continue
+        merged[band] = np.column_stack([hists[0, :, 0], hists[:, :, 1].sum(axis=0)])
+    merged['lc'] = {}
+    for h in tile_histograms:
+        for key, count in (h.get('lc') or {}).items():
+            if key != '0':
+                merged['lc'][key] = merged['lc'].get(key, 0) + count
+    return merged
+
+def protected_area_overlap(wdpa, region_geometry):
+    # filterBounds keeps only the polygons that intersect the region, the intersection runs with a 1 m error margin
+    wdpa_filtered = wdpa.filterBounds(region_geometry)
+    overlap = wdpa_filtered.map(lambda feature: feature.set(
+        'ha', feature.geometry().intersection(region_geometry, ee.ErrorMargin(1)).area(1).divide(1e4)))
+    return overlap.aggregate_sum('ha')
+
+def water_buffer(water_bodies, forest, distances, region, crs):
+    # one forest area per buffer distance, mapped server-side so all distances come back in one list
+    def forest_area_within(dis):
+        # dilate the water mask by dis meters (circular kernel), much cheaper than a cumulativeCost flood-fill
+        buffered_water = water_bodies.focalMax(radius=ee.Number(dis), units='meters')
+        # Intersect the forest raster with the buffered water mask
+        forest_near_water = forest.updateMask(buffered_water)
+        # Calculate the total forest coverage within dis meters of water bodies
+        forest_area = forest_near_water.multiply(ee.Image.pixelArea()).reduceRegion(
+            reducer=ee.Reducer.sum(),
+            geometry=region,  # Use the extent of the project area
+            scale=10,
+            crs=f'EPSG:{crs}',# Match the dataset resolution
+            maxPixels=1e9
+        )
+        return forest_area.get('Map')
+    return ee.List(distances).map(forest_area_within)
 
 
 def parse_arguments():
@@ -81,32 +156,37 @@ map_class_table = {10: 'Tree Cover',
                    90: 'Herbaceous wetland',
                    95: 'Mangroves',
                    100: 'Moss and lichen'}
+map_class_series = pd.Series(map_class_table)
     
 if __name__ == '__main__':
     # initial ee
-    ee.Initialize()
+    ee.Initialize(opt_url='https://earthengine-highvolume.googleapis.com')
     
     # add args
     args = parse_arguments()
     year = args.year
-    new_path = f'Projects/ACR/{args.pid}/{args.pid}_wgs84_p_1ha.shp'
+    # the filtered, reprojected project area is kept as GeoParquet, smaller and faster to reload than a shapefile
+    new_path = f'Projects/ACR/{args.pid}/{args.pid}_wgs84_p_1ha.parquet'
     if os.path.exists(new_path):
-        project_df = gpd.read_file(new_path)
-        crs = project_df.crs
-        epsg_number = str(crs).split(':')[-1]
+        project_df = gpd.read_parquet(new_path)
+        epsg_number = project_df.crs.to_epsg()
     else:
         file_path = glob(f"Projects/ACR/{args.pid}/*.shp")[0]
         # load shapefile with geopandas and convert its crs to utm
         epsg_number, project_df_filter = crs_conversion(file_path)
-        project_df_filter.to_file(new_path)
+        project_df_filter.to_parquet(new_path)
+        project_df = project_df_filter
     
-    # loading project shapefile
+    # loading project area
     print(' ')
-    print("Uploading project shapefile to GEE")
-    pa = geemap.shp_to_ee(new_path)
-    pa_area = round(pa.geometry().area(1).getInfo()/10000, 2)
-    print(f"Project shapefile: {new_path.split('/')[-1]} uploaded!") 
-    print(f"Project area: {pa_area} ha, or {pa_area * 2.47:.2f} acres")
+    print("Uploading project area to GEE")
+    # build the collection from the GeoDataFrame already in memory instead of re-reading the file
+    pa = geemap.geopandas_to_ee(project_df.to_crs(epsg=4326), geodesic=False)
+    # bind the project geometry once so every reduction below reuses the same node of the expression graph
+    pa_geom = pa.geometry()
+    # the area stays a deferred ee.Number, it is fetched with the rest of the report
+    pa_area_m2 = pa_geom.area(1)
+    print(f"Project area file: {new_path.split('/')[-1]} uploaded!") 
     print(" ")
     
     # loading all datasets
@@ -147,9 +227,24 @@ if __name__ == '__main__':
     # Protection area dataset
     wdpa = ee.FeatureCollection('WCMC/WDPA/current/polygons')
     
+    # all reductions below are built server-side into one dictionary and fetched with a single getInfo(),
+    # cached by its serialized expression, which inlines the project geometry, so any change of geometry
+    # or parameters is a cache miss
+    report = ee.Dictionary({'pa_area': pa_area_m2.divide(1e4),
+                'gfc_loss': get_annual_loss(gfc_loss_image, gfc_loss_year, pa_geom, epsg_number),
+                'histograms_10m': combined_10m_histograms(slope, dataset, canopy_height, pa_geom, epsg_number),
+                'water': water_buffer(water_bodies, forest, [20, 30], pa_geom, epsg_number),
+                'agb': region_histogram(agb_2010, ee.Reducer.fixedHistogram(0, 450, 45), 'AGB', pa_geom, 100, epsg_number),
+                'wdpa': protected_area_overlap(wdpa, pa_geom)})
+    results = cached_getinfo('report', {'expression': report.serialize()}, report.getInfo)
+    histograms_10m = merge_tile_histograms(results['histograms_10m'])
+    pa_area = round(results['pa_area'], 2)
+    print(f"Project area: {pa_area} ha, or {pa_area * 2.47:.2f} acres")
+    print(" ")
+    
     print('##########Using GFW to check prior logging######################################')
-    pa_years_def_gfc, pa_annual_deforestation_gfc = get_annual_loss(gfc_loss_image, gfc_loss_year, pa, epsg_number)
-    df_gfc = pd.DataFrame({'Def_PA': pa_annual_deforestation_gfc}, index=[d+2000 for d in pa_years_def_gfc])
+    pa_years_def_gfc, pa_annual_deforestation_gfc = parse_annual_loss(results['gfc_loss'])
+    df_gfc = pd.DataFrame({'Def_PA': pa_annual_deforestation_gfc}, index=pa_years_def_gfc + 2000)
     df_gfc['Def_PA_rate (%)'] = df_gfc['Def_PA'] * 100 / pa_area
     print(df_gfc)
     print(f"from 2000 to {year}, the mean deforestation rate in PA: {df_gfc.loc[df_gfc.index <= year, 'Def_PA_rate (%)'].mean():.2f} %")
@@ -158,64 +253,55 @@ if __name__ == '__main__':
     print('##########Using slope from DEM to check forever unsuitable cut-off area##########')
     # Digital elevation model (DEM) for forever unsuitable harvest analysis
     # slope and extreme analysis
-    histogram = slope.reduceRegion(reducer=ee.Reducer.fixedHistogram(0, 90, 18), 
-                                   geometry=pa, scale=10, crs=f'EPSG:{epsg_number}', maxPixels=1e9)
-    hist_data = histogram.get('slope').getInfo()
+    hist_data = histograms_10m['slope']
     df = pd.DataFrame(hist_data, columns=['Slope [v, v+5)', 'Frequency'])
     df['Percent (%)'] = (df['Frequency'] / df['Frequency'].sum()) * 100
     df['CumulativeP (%)'] = df['Percent (%)'].cumsum()
     print(df)
-    # print(f"Areas with Slope > 25 degrees: {round(100-df.loc[df['Slope [v, v+5)'] == 20]['CumulativeP (%)'].item(), 2)} %")
+    # the bins have a fixed width, so the row of bin edge v is v // width and .at looks it up directly
+    # print(f"Areas with Slope > 25 degrees: {round(100-df.at[20 // 5, 'CumulativeP (%)'], 2)} %")
     # to do plot
     print('')
     
     print('##########Using ESA land cover to calculate the land cover composition in PA######')
     # land cover composition in project area
-    landcover_counts = dataset.reduceRegion(reducer=ee.Reducer.frequencyHistogram(), 
-                                            geometry=pa, scale=10, crs=f'EPSG:{epsg_number}', maxPixels=1e9)
-    class_counts = landcover_counts.get('Map').getInfo()
+    class_counts = histograms_10m['lc']
     df = pd.DataFrame(list(class_counts.items()), columns=['LandCoverID', 'PixelCount'])
     df['Percentage (%)'] = (df['PixelCount'] / df['PixelCount'].sum()) * 100
-    df['LandCoverClass'] = [map_class_table[int(i)] for i in df['LandCoverID']]
+    df['LandCoverID'] = df['LandCoverID'].astype(np.int16)
+    df['LandCoverClass'] = df['LandCoverID'].map(map_class_series)
     print(df)
     print(' ')
     
     print('##########Using water and forest class in ESA to calculate near-water forests in PA#######')
     # Near-water forest areas
-    print('66 feet buffer: ')
-    water_buffer(water_bodies, forest, 20, epsg_number)
-    print('100 feet buffer: ')
-    water_buffer(water_bodies, forest, 30, epsg_number)
+    for dis, label, total_forest_area in zip([20, 30], ['66 feet buffer: ', '100 feet buffer: '], results['water']):
+        print(label)
+        print(f"Total forest area within {dis} meters buffer of water: {total_forest_area / 1e4:.2f} hectares, {100 * total_forest_area / 1e4 / pa_area:.4f}%")
     print('')
     
     # biomass 
     print('##########Using ESA 100m biomass and ETH global canopy height 10m to calculate imminent harvest areas in PA')
-    histogram = agb_2010.reduceRegion(reducer=ee.Reducer.fixedHistogram(0, 450, 45), 
-                                      geometry=pa, scale=100, crs=f'EPSG:{epsg_number}', maxPixels=1e9)
-    hist_data = histogram.get('AGB').getInfo()
+    hist_data = results['agb']
     df = pd.DataFrame(hist_data, columns=['Biomass (Mg/ha) [v, v+10)', 'Frequency'])
     df['Percent (%)'] = (df['Frequency'] / df['Frequency'].sum()) * 100
     df['CumulativeP (%)'] = df['Percent (%)'].cumsum()
     print(df)
-    print(f"Areas with biomass > 270 Mg/ha: {round(100-df.loc[df['Biomass (Mg/ha) [v, v+10)'] == 230]['CumulativeP (%)'].item(), 2)} %")
+    print(f"Areas with biomass > 270 Mg/ha: {round(100-df.at[230 // 10, 'CumulativeP (%)'], 2)} %")
     # to do plot
     print(' ')
     # tree height
-    histogram = canopy_height.reduceRegion(reducer=ee.Reducer.fixedHistogram(0, 50, 10), 
-                                           geometry=pa, crs=f'EPSG:{epsg_number}', scale=10, maxPixels=1e9)
-    hist_data = histogram.get('b1').getInfo()
+    hist_data = histograms_10m['ch']
     df = pd.DataFrame(hist_data, columns=['Tree Height (m) [v, v+5)', 'Frequency'])
     df['Percent (%)'] = (df['Frequency'] / df['Frequency'].sum()) * 100
     df['CumulativeP (%)'] = df['Percent (%)'].cumsum()
     print(df)
-    print(f"Areas with tree height > 30 m: {round(100-df.loc[df['Tree Height (m) [v, v+5)'] == 25]['CumulativeP (%)'].item(), 2)} %")
+    print(f"Areas with tree height > 30 m: {round(100-df.at[25 // 5, 'CumulativeP (%)'], 2)} %")
     # to do plot
     print('')
     
     print('###########Using WDPA (polygon) dataset for calculating protection areas in PA##########')
-    wdpa_filtered = wdpa.filterBounds(pa.geometry())
-    overlap = wdpa_filtered.map(lambda feature: feature.set('ha', feature.intersection(pa.geometry()).area(1).divide(1e4)))
-    total_overlap_area = overlap.aggregate_sum('ha').getInfo()
+    total_overlap_area = results['wdpa']
     print(f"Total protection area in PA: {total_overlap_area:.2f} ha, around {100 * total_overlap_area/pa_area} % PA area")
     print('Datasets used and related links:')
     print('1. Historical deforestation trend, Global Forest Change, link: https://storage.googleapis.com/earthenginepartners-hansen/GFC-2023-v1.11/download.html')